@@ -38,12 +38,31 @@ KeyError: 'Invalid vim option: se'
 {'filetype': 'python', 'syntax': 'perl', 'textwidth': '80'}
 >>> pprint(p.parse_line('vim:noai:ari'))
 {'allowrevins': True, 'autoindent': False}
+>>> p.modelines = 1
+>>> pprint(p.parse_buffer('vim:ts=4\\nvim:sw=2\\nvim:tw=80\\nfoo'))
+{'tabstop': '4'}
+>>> pprint(p.parse_buffer('vim>730:ts=4'))
+{}
+>>> p.vim_version = 731
+>>> pprint(p.parse_buffer('vim>730:ts=4'))
+{'tabstop': '4'}
+>>> pprint(p.parse_buffer(b'foo\\n# vim:set ts=4 sw=2:'))
+{'shiftwidth': '2', 'tabstop': '4'}
 """
 
-import re
+import functools, operator, re
 
 from optionlist import boolean_options, option_mapping, option_list
 
+# all valid option names mapped to the long ones, including 'no*'
+# variants.
+_long_options = dict((k, k) for k in option_list)
+_long_options.update(option_mapping)
+_long_options.update([('no' + k, v) for k, v in _long_options.items()])
+
+# buffers which need decoding; in Python 2, str is bytes already.
+_binary_types = (bytes, bytearray) if bytes is not str else ()
+
 class ModelineDict(dict):
 	"""
 	Dict wrapper mapping option names.
@@ -55,13 +74,12 @@ class ModelineDict(dict):
 
 	@staticmethod
 	def _get_long_option(key):
-		if key.startswith('no'):
-			key = key[2:]
-		if key in option_mapping:
-			key = option_mapping[key]
-		elif key not in option_list:
+		try:
+			return _long_options[key]
+		except KeyError:
+			if key[:2] == 'no':
+				key = key[2:]
 			raise KeyError('Invalid vim option: %s' % key)
-		return key
 
 	def __getitem__(self, key):
 		return dict.__getitem__(self, self._get_long_option(key))
@@ -90,6 +108,25 @@ class ModelineParser(object):
 	_modelines = 5
 	_vim_version = 730
 
+	# the maximal number of lines kept in the parse cache.
+	_line_cache_size = 4096
+	# longer lines are not cached, to keep the cache size sane.
+	_line_cache_max_length = 200
+
+	def __init__(self):
+		self._line_cache = {}
+		self._update_version_checks()
+
+	def _update_version_checks(self):
+		"""
+		Bind the current vim_version into the version requirement
+		checks, so that they take only the required version.
+		"""
+
+		ver = self._vim_version
+		self._version_checks = dict((op, functools.partial(f, ver))
+				for op, f in self._version_ops.items())
+
 	@property
 	def modelines(self):
 		"""
@@ -98,11 +135,11 @@ class ModelineParser(object):
 
 		Defaults to 5.
 		"""
-		return _modelines
+		return self._modelines
 
 	@modelines.setter
 	def modelines(self, new_val):
-		_modelines = new_val
+		self._modelines = new_val
 
 	@property
 	def vim_version(self):
@@ -124,11 +161,19 @@ class ModelineParser(object):
 	@vim_version.setter
 	def vim_version(self, new_val):
 		self._vim_version = new_val
+		self._update_version_checks()
+		# the cached results depend on the version.
+		self._line_cache.clear()
 
 	def parse_buffer(self, buf):
 		"""
 		Parse the modelines from buffer.
 
+		The buffer can be either a text string or a bytes object.
+		In Python 3, only the bytes lines which can contain a modeline
+		are decoded (as UTF-8). In Python 2, byte strings are parsed
+		as-is, without decoding.
+
 		Returns a dict with options and their values.
 		"""
 
@@ -137,34 +182,41 @@ class ModelineParser(object):
 		mls = self._modelines
 		ret = ModelineDict()
 
-		# XXX: replace it with something more efficient. And prevent
-		# parsing the same lines twice.
-		for l in buf.splitlines()[:mls]:
-			ret.update(self.parse_line(l))
-		for l in buf.splitlines()[-mls:]:
-			ret.update(self.parse_line(l))
+		lines = buf.splitlines()
+		n = len(lines)
+		if isinstance(buf, _binary_types):
+			parse = self._parse_binary_line
+		else:
+			parse = self._parse_line_cached
+
+		for l in lines[:mls]:
+			for k, v in parse(l):
+				ret[k] = v
+		# the tail window may overlap the head one in short buffers;
+		# skip the lines which were parsed already.
+		for l in lines[max(mls, n - mls):]:
+			for k, v in parse(l):
+				ret[k] = v
 
 		return ret
 
-	_modeline_re = re.compile(r'''
-		^
-
-		(?:
-			# vi: or vim: either on start-of-line or following
-			# whitespace.
-			(?: .*? \s+ )?
-			(?: vi (?P<has_vim> m )? )
-
-			# or ex: following whitespace.
-			| .*? \s+ ex
+	# vi: or vim: either on start-of-line or following whitespace,
+	# or ex: following whitespace. This only locates the candidates,
+	# _modeline_re is matched afterwards at their end.
+	_marker_re = re.compile(r'''
+		(?: ^ | (?<= \s ) )
+		(?P<marker>
+			# vim: can be followed by a version requirement.
+			vim (?= [<=>\d:] )
+			| (?: vi | ex ) (?= : )
 		)
+	''', re.VERBOSE)
 
+	_modeline_re = re.compile(r'''
 		# optionally, a version requirement
-		# but only for 'vim'
-		(?(has_vim)
-			(?P<version_op> [<=>] )?
-			(?P<version_no> \d* )
-		)
+		# (_marker_re allows it only for 'vim').
+		(?P<version_op> [<=>] )?
+		(?P<version_no> \d* )
 
 		:
 
@@ -196,9 +248,22 @@ class ModelineParser(object):
 
 	# it can be common to both forms since in form2 unescaped :
 	# acts as end-of-modeline.
-	_option_split_re = re.compile(r'''
-		# either space or : but not preceded by a backslash.
-		(?<! \\ ) [:\s]+
+	_option_re = re.compile(r'''
+		# an option starts with anything but space or :.
+		(?= [^:\s] )
+
+		# the option name, up to = or unescaped space or :.
+		(?P<key>
+			(?: \\ [:\s] | [^:\s=] )*
+		)
+
+		# optionally, = and value up to unescaped space or :.
+		(?:
+			=
+			(?P<value>
+				(?: \\ [:\s] | [^:\s] )*
+			)
+		)?
 	''', re.VERBOSE)
 
 	_option_unescape_re = re.compile(r'''
@@ -206,45 +271,130 @@ class ModelineParser(object):
 		\\ ( [:\s] )
 	''', re.VERBOSE)
 
-	def parse_line(self, l):
+	# version requirement operators; no operator means 'at least'.
+	_version_ops = {
+		'>': operator.gt,
+		'=': operator.eq,
+		'<': operator.lt,
+		None: operator.ge
+	}
+
+	def _find_markers(self, l):
+		"""
+		Find the candidate modeline markers in line l.
+
+		Yields the _marker_re matches in the order they should be tried:
+		vi:/vim: following whitespace first, then the one on
+		start-of-line and ex: last.
+		"""
+
+		deferred = []
+		for mm in self._marker_re.finditer(l):
+			if mm.group('marker') == 'ex':
+				# ex: needs to follow whitespace.
+				if mm.start() != 0:
+					deferred.append(mm)
+			elif mm.start() == 0:
+				deferred.insert(0, mm)
+			else:
+				yield mm
+
+		for mm in deferred:
+			yield mm
+
+	def _parse_line(self, l):
 		"""
 		Parse a single line for a modeline.
 
-		Returns a dict with options and their values.
+		Returns a list of (key, value) tuples, with the option names
+		not mapped yet.
 		"""
 
-		ret = ModelineDict()
+		ret = []
 
-		m = self._modeline_re.match(l)
-		if m:
-			applies = False
-
-			ver_no = int(m.group('version_no') or '0')
-			ver_op = m.group('version_op')
-			if ver_op == '>':
-				applies = self._vim_version > ver_no
-			elif ver_op == '=':
-				applies = self._vim_version == ver_no
-			elif ver_op == '<':
-				applies = self._vim_version < ver_no
-			else:
-				applies = self._vim_version >= ver_no
+		# most lines don't contain a modeline at all, and a plain
+		# substring test is much cheaper than running the regex.
+		if 'vi' not in l and 'ex:' not in l:
+			return ret
 
-			if not applies:
-				return ret
+		match = self._modeline_re.match
+		for mm in self._find_markers(l):
+			m = match(l, mm.end())
+			if m:
+				break
+		else:
+			m = None
+
+		if m:
+			ver_op, ver_no = m.group('version_op', 'version_no')
+			# most modelines don't have a version requirement at all.
+			if ver_op or ver_no:
+				applies = self._version_checks[ver_op](int(ver_no or '0'))
+				if not applies:
+					return ret
 
-			for o in re.split(self._option_split_re, m.group('options')):
-				kv = o.split('=', 1)
-				key = kv[0]
+			unescape = self._option_unescape_re.sub
+			for o in self._option_re.finditer(m.group('options')):
+				key, value = o.group('key', 'value')
 
 				if not key:
 					continue
 
-				if len(kv) > 1:
-					value = self._option_unescape_re.sub(r'\1', kv[1])
-				else:
-					value = None
+				if value and '\\' in value:
+					value = unescape(r'\1', value)
 
-				ret[key] = value
+				ret.append((key, value))
 
 		return ret
+
+	def _parse_line_cached(self, l):
+		"""
+		Parse a single line for a modeline, using the line cache.
+
+		Repeated modelines are common across files, so keep the results
+		for them. Lines without modeline markers are cheap to parse
+		and therefore not cached, and neither are long lines.
+		"""
+
+		if (len(l) > self._line_cache_max_length
+				or ('vi' not in l and 'ex:' not in l)):
+			return self._parse_line(l)
+
+		# in Python 2, str and unicode lines compare equal but give
+		# values of different types.
+		key = (type(l), l)
+		cache = self._line_cache
+		try:
+			return cache[key]
+		except KeyError:
+			pass
+
+		ret = self._parse_line(l)
+		if len(cache) >= self._line_cache_size:
+			cache.clear()
+		cache[key] = ret
+		return ret
+
+	def _parse_binary_line(self, l):
+		"""
+		Parse a single bytes line for a modeline.
+
+		The line is decoded only if it passes the quick check
+		for modeline markers.
+		"""
+
+		if b'vi' not in l and b'ex:' not in l:
+			return []
+		return self._parse_line_cached(l.decode('utf8', 'replace'))
+
+	def parse_line(self, l):
+		"""
+		Parse a single line for a modeline.
+
+		Returns a dict with options and their values.
+		"""
+
+		ret = ModelineDict()
+		for k, v in self._parse_line(l):
+			ret[k] = v
+		return ret